@@ -14,7 +14,7 @@
 
 from __future__ import print_function
 
-import copy
+import bisect
 import math
 import numpy as np
 import unittest
@@ -30,10 +30,10 @@ def exponential_decay(learning_rate,
                       decay_steps,
                       decay_rate,
                       staircase=False):
-    exponent = global_step / decay_steps
+    exponent = np.divide(global_step, float(decay_steps))
     if staircase:
-        exponent = math.floor(exponent)
-    return learning_rate * decay_rate**exponent
+        exponent = np.floor(exponent)
+    return learning_rate * np.power(decay_rate, exponent)
 
 
 def natural_exp_decay(learning_rate,
@@ -41,10 +41,10 @@ def natural_exp_decay(learning_rate,
                       decay_steps,
                       decay_rate,
                       staircase=False):
-    exponent = float(global_step) / float(decay_steps)
+    exponent = np.divide(global_step, float(decay_steps))
     if staircase:
-        exponent = math.floor(exponent)
-    return learning_rate * math.exp(-1 * decay_rate * exponent)
+        exponent = np.floor(exponent)
+    return learning_rate * np.exp(-1 * decay_rate * exponent)
 
 
 def inverse_time_decay(learning_rate,
@@ -52,9 +52,9 @@ def inverse_time_decay(learning_rate,
                        decay_steps,
                        decay_rate,
                        staircase=False):
-    temp = float(global_step) / float(decay_steps)
+    temp = np.divide(global_step, float(decay_steps))
     if staircase:
-        temp = math.floor(temp)
+        temp = np.floor(temp)
     return learning_rate / (1 + decay_rate * temp)
 
 
@@ -65,35 +65,30 @@ def polynomial_decay(learning_rate,
                      power=1.0,
                      cycle=False):
     if cycle:
-        div = math.ceil(global_step / float(decay_steps))
-        if div == 0:
-            div = 1
-        decay_steps = decay_steps * div
+        div = np.ceil(np.divide(global_step, float(decay_steps)))
+        decay_steps = decay_steps * np.maximum(div, 1)
     else:
-        global_step = min(global_step, decay_steps)
+        global_step = np.minimum(global_step, decay_steps)
     return (learning_rate - end_learning_rate) * \
-           ((1 - float(global_step) / float(decay_steps)) ** power) + end_learning_rate
+           ((1 - np.divide(global_step, decay_steps)) ** power) + end_learning_rate
 
 
 def piecewise_decay(global_step, boundaries, values):
-    assert len(boundaries) + 1 == len(values)
-    for i in range(len(boundaries)):
-        if global_step < boundaries[i]:
-            return values[i]
-    return values[len(values) - 1]
+    return np.asarray(values)[np.searchsorted(
+        boundaries, global_step, side='right')]
 
 
 def cosine_decay(global_step, learning_rate, step_each_epoch, epochs):
-    cur_epoch = math.floor(global_step / step_each_epoch)
+    cur_epoch = np.floor(np.divide(global_step, float(step_each_epoch)))
     decayed_lr = learning_rate * 0.5 * (
-        math.cos(cur_epoch * math.pi / epochs) + 1)
+        np.cos(cur_epoch * math.pi / epochs) + 1)
     return decayed_lr
 
 
 def noam_decay(global_step, d_model, warmup_steps, learning_rate=1.0):
-    a = math.pow(global_step, -0.5)
-    b = math.pow(warmup_steps, -1.5) * global_step
-    decayed_lr = learning_rate * math.pow(d_model, -0.5) * min(a, b)
+    a = 1.0 / np.sqrt(global_step)
+    b = global_step / (warmup_steps * math.sqrt(warmup_steps))
+    decayed_lr = learning_rate / math.sqrt(d_model) * np.minimum(a, b)
 
     return decayed_lr
 
@@ -105,17 +100,22 @@ def linear_lr_warmup(global_step, warmup_steps, start_lr, end_lr):
 
 
 def multi_step_decay(global_step, learning_rate, milestones, decay_rate=0.1):
-    for i in range(len(milestones)):
-        if global_step < milestones[i]:
-            return learning_rate * math.pow(decay_rate, i)
-
-    return learning_rate * math.pow(decay_rate, len(milestones))
+    return learning_rate * decay_rate**bisect.bisect_right(
+        milestones, global_step)
 
 
 def step_decay(global_step, learning_rate, step_size, decay_rate=0.1):
     return learning_rate * math.pow(decay_rate, global_step // step_size)
 
 
+def run_lr_steps(exe, main_prog, decayed_lr, num_steps):
+    # Run all the steps first, the results are checked as a whole later.
+    return np.array([
+        exe.run(main_prog, feed={}, fetch_list=[decayed_lr])[0][0]
+        for _ in range(num_steps)
+    ])
+
+
 class TestLearningRateDecayDygraph(unittest.TestCase):
     def test_NoamDecay(self):
         with fluid.dygraph.guard():
@@ -123,17 +123,21 @@ class TestLearningRateDecayDygraph(unittest.TestCase):
             warmup_steps = 200
             learning_rate = 2.0
             lr = fluid.layers.noam_decay(d_model, warmup_steps, learning_rate)
-            for step in range(5):
-                step += 1
-                right_result = noam_decay(step, d_model, warmup_steps,
-                                          learning_rate)
-                fluid_result = lr()
-
-                self.assertAlmostEqual(
-                    right_result,
-                    fluid_result[0],
-                    msg='Failed lr scheduler in step {0}, Python result is {1}, Fluid result is {2}'.
-                    format(step, right_result, fluid_result[0]))
+            right_result = np.empty(5)
+            fluid_result = np.empty(5)
+            for i in range(5):
+                step = i + 1
+                right_result[i] = noam_decay(step, d_model, warmup_steps,
+                                             learning_rate)
+                fluid_result[i] = float(lr())
+
+            np.testing.assert_allclose(
+                fluid_result,
+                right_result,
+                rtol=0,
+                atol=5e-8,
+                err_msg='Failed lr scheduler, Python result is {0}, Fluid result is {1}'.
+                format(right_result, fluid_result))
 
     def test_LinearLrWarmup(self):
         with fluid.dygraph.guard():
@@ -146,12 +150,12 @@ class TestLearningRateDecayDygraph(unittest.TestCase):
                 learning_rate=lr, warmup_steps=2, start_lr=0.0, end_lr=1.0)
 
             right_result = [0.5, 0.9, 0.8, 0.7, 0.6]
+            fluid_result = np.empty(5)
             for i in range(5):
+                fluid_result[i] = float(lr())
 
-                t = lr()
-
-                self.assertTrue(
-                    np.allclose((t.numpy())[0].item(), right_result[i]))
+            np.testing.assert_allclose(
+                fluid_result, right_result, rtol=1e-5, atol=1e-8)
 
             with self.assertRaises(TypeError):
                 lr = fluid.layers.linear_lr_warmup(
@@ -167,16 +171,21 @@ class TestLearningRateDecayDygraph(unittest.TestCase):
             decay_rate = 0.2
             scheduler = fluid.dygraph.MultiStepDecay(learning_rate, milestones,
                                                      decay_rate)
+            right_result = np.empty(10)
+            fluid_result = np.empty(10)
             for epoch in range(10):
-                right_result = multi_step_decay(epoch, learning_rate,
-                                                milestones, decay_rate)
-                fluid_result = scheduler().numpy()[0]
+                right_result[epoch] = multi_step_decay(epoch, learning_rate,
+                                                       milestones, decay_rate)
+                fluid_result[epoch] = float(scheduler())
                 scheduler.epoch()
-                self.assertAlmostEqual(
-                    right_result,
-                    fluid_result,
-                    msg='Failed lr scheduler in step {0}, Python result is {1}, Fluid result is {2}'.
-                    format(epoch, right_result, fluid_result))
+
+            np.testing.assert_allclose(
+                fluid_result,
+                right_result,
+                rtol=0,
+                atol=5e-8,
+                err_msg='Failed lr scheduler, Python result is {0}, Fluid result is {1}'.
+                format(right_result, fluid_result))
 
             with self.assertRaises(ValueError):
                 lr = fluid.dygraph.MultiStepDecay(learning_rate, [30, 50, 20],
@@ -199,16 +208,21 @@ class TestLearningRateDecayDygraph(unittest.TestCase):
             decay_rate = 0.2
             scheduler = fluid.dygraph.StepDecay(learning_rate, step_size,
                                                 decay_rate)
+            right_result = np.empty(10)
+            fluid_result = np.empty(10)
             for epoch in range(10):
-                right_result = step_decay(epoch, learning_rate, step_size,
-                                          decay_rate)
-                fluid_result = scheduler().numpy()[0]
+                right_result[epoch] = step_decay(epoch, learning_rate,
+                                                 step_size, decay_rate)
+                fluid_result[epoch] = float(scheduler())
                 scheduler.epoch()
-                self.assertAlmostEqual(
-                    right_result,
-                    fluid_result,
-                    msg='Failed lr scheduler in step {0}, Python result is {1}, Fluid result is {2}'.
-                    format(epoch, right_result, fluid_result))
+
+            np.testing.assert_allclose(
+                fluid_result,
+                right_result,
+                rtol=0,
+                atol=5e-8,
+                err_msg='Failed lr scheduler, Python result is {0}, Fluid result is {1}'.
+                format(right_result, fluid_result))
 
             with self.assertRaises(TypeError):
                 lr = fluid.dygraph.MultiStepDecay(learning_rate, "test", 0.1)
@@ -219,11 +233,16 @@ class TestLearningRateDecayDygraph(unittest.TestCase):
 
 
 class TestLearningRateDecay(unittest.TestCase):
-    def check_decay(self, python_decay_fn, fluid_decay_fn, kwargs):
-        places = [fluid.CPUPlace()]
+    @classmethod
+    def setUpClass(cls):
+        cls._places = [fluid.CPUPlace()]
         if core.is_compiled_with_cuda():
-            places.append(fluid.CUDAPlace(0))
-        for place in places:
+            cls._places.append(fluid.CUDAPlace(0))
+        cls._exes = dict(
+            (str(place), fluid.Executor(place)) for place in cls._places)
+
+    def check_decay(self, python_decay_fn, fluid_decay_fn, kwargs):
+        for place in self._places:
             self.check_decay_with_place(place, python_decay_fn, fluid_decay_fn,
                                         kwargs)
 
@@ -235,24 +254,24 @@ class TestLearningRateDecay(unittest.TestCase):
         with fluid.program_guard(main_prog, startup_prog):
             decayed_lr = fluid_decay_fn(**kwargs)
 
-        place = fluid.CPUPlace()
-        exe = fluid.Executor(place)
-
+        exe = self._exes[str(place)]
         exe.run(startup_prog)
 
-        for step in range(10):
-            # Step of NoamDecay starts from 1.
-            if python_decay_fn.__name__ == 'noam_decay':
-                step += 1
-            lr_val, = exe.run(main_prog, feed={}, fetch_list=[decayed_lr])
-            python_decayed_lr = python_decay_fn(
-                global_step=float(step), **kwargs)
-            self.assertAlmostEqual(
-                python_decayed_lr,
-                lr_val[0],
-                msg='Failed lr scheduler is {0}, step {1}, Python result is {2}, Fluid result is {3}'.
-                format(python_decay_fn.__name__,
-                       str(step), str(python_decayed_lr), str(lr_val[0])))
+        # Step of NoamDecay starts from 1.
+        steps = np.arange(10, dtype='float64')
+        if python_decay_fn.__name__ == 'noam_decay':
+            steps += 1
+
+        lr_vals = run_lr_steps(exe, main_prog, decayed_lr, len(steps))
+        python_decayed_lr = python_decay_fn(global_step=steps, **kwargs)
+        np.testing.assert_allclose(
+            lr_vals,
+            python_decayed_lr,
+            rtol=0,
+            atol=5e-8,
+            err_msg='Failed lr scheduler is {0}, Python result is {1}, Fluid result is {2}'.
+            format(python_decay_fn.__name__,
+                   str(python_decayed_lr), str(lr_vals)))
 
     def test_decay(self):
         common_kwargs_true = {
@@ -261,8 +280,7 @@ class TestLearningRateDecay(unittest.TestCase):
             "decay_rate": 0.5,
             "staircase": True
         }
-        common_kwargs_false = copy.deepcopy(common_kwargs_true)
-        common_kwargs_false["staircase"] = False
+        common_kwargs_false = dict(common_kwargs_true, staircase=False)
 
         decay_fns = [
             (exponential_decay, layers.exponential_decay, common_kwargs_true),
@@ -293,13 +311,24 @@ class TestLearningRateDecay(unittest.TestCase):
              })
         ]
 
-        for py_decay_fn, fluid_decay_fn, kwargs in decay_fns:
-            print("class=" + self.__class__.__name__ + " decay_fn=" +
-                  py_decay_fn.__name__ + " kwargs=" + str(kwargs))
-            main_program = framework.Program()
-            startup_program = framework.Program()
-            with framework.program_guard(main_program, startup_program):
-                self.check_decay(py_decay_fn, fluid_decay_fn, kwargs)
+        # NOTE: The cases are run one by one. program_guard switches the
+        # global default programs and all the schedulers share the same
+        # @LR_DECAY_COUNTER@ variable in the global scope, so they can not be
+        # run concurrently in threads.
+        for case in decay_fns:
+            self.run_one_case(case)
+
+    def run_one_case(self, case):
+        py_decay_fn, fluid_decay_fn, kwargs = case
+        if py_decay_fn is piecewise_decay:
+            self.assertEqual(
+                len(kwargs["boundaries"]) + 1, len(kwargs["values"]))
+        print("class=" + self.__class__.__name__ + " decay_fn=" +
+              py_decay_fn.__name__ + " kwargs=" + str(kwargs))
+        main_program = framework.Program()
+        startup_program = framework.Program()
+        with framework.program_guard(main_program, startup_program):
+            self.check_decay(py_decay_fn, fluid_decay_fn, kwargs)
 
 
 class TestLinearWamrupLearningRateDecay(unittest.TestCase):
@@ -316,30 +345,43 @@ class TestLinearWamrupLearningRateDecay(unittest.TestCase):
             decayed_lr = layers.linear_lr_warmup(
                 fluid_decay_fn(**kwargs), warmup_steps, start_lr, end_lr)
 
-        place = fluid.CPUPlace()
         exe = fluid.Executor(place)
         exe.run(startup_prog)
 
-        for step in range(20):
+        lr_vals = run_lr_steps(exe, main_prog, decayed_lr, 20)
+
+        python_decayed_lr = np.empty(20)
+        for i in range(20):
+            step = i
             # Step of NoamDecay starts from 1.
             if fluid_decay_fn.__name__ == 'noam_decay':
                 step += 1
-            lr_val, = exe.run(main_prog, feed={}, fetch_list=[decayed_lr])
             if step < warmup_steps:
-                python_decayed_lr = linear_lr_warmup(
+                python_decayed_lr[i] = linear_lr_warmup(
                     float(step), warmup_steps, start_lr, end_lr)
             else:
-                python_decayed_lr = python_decay_fn(
+                python_decayed_lr[i] = python_decay_fn(
                     global_step=float(step), **kwargs)
-            self.assertAlmostEqual(
-                python_decayed_lr,
-                lr_val[0],
-                msg='Test {0} Failed, step {1}, Python result is {2}, Fluid result is {3}'.
-                format(python_decay_fn.__name__,
-                       str(step), str(python_decayed_lr), str(lr_val[0])))
+
+        np.testing.assert_allclose(
+            lr_vals,
+            python_decayed_lr,
+            rtol=0,
+            atol=5e-8,
+            err_msg='Test {0} Failed, Python result is {1}, Fluid result is {2}'.
+            format(python_decay_fn.__name__,
+                   str(python_decayed_lr), str(lr_vals)))
 
 
 class TestLinearWamrupLearningRateDecayWithScalarInput(unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        cls._places = [fluid.CPUPlace()]
+        if core.is_compiled_with_cuda():
+            cls._places.append(fluid.CUDAPlace(0))
+        cls._exes = dict(
+            (str(place), fluid.Executor(place)) for place in cls._places)
+
     def run_scalar_lr(self, place, lr, start_lr, end_lr):
         main_prog = fluid.Program()
         startup_prog = fluid.Program()
@@ -350,28 +392,27 @@ class TestLinearWamrupLearningRateDecayWithScalarInput(unittest.TestCase):
             decayed_lr = layers.linear_lr_warmup(lr, warmup_steps, start_lr,
                                                  end_lr)
 
-        exe = fluid.Executor(place)
+        exe = self._exes[str(place)]
         exe.run(startup_prog)
 
-        for step in range(20):
-            lr_val, = exe.run(main_prog, feed={}, fetch_list=[decayed_lr])
-            if step < warmup_steps:
-                expected_lr = linear_lr_warmup(
-                    float(step), warmup_steps, start_lr, end_lr)
-            else:
-                expected_lr = lr
-            self.assertAlmostEqual(
-                expected_lr,
-                lr_val[0],
-                msg='Test failed, step {0}, expected {1}, but got {2}'.format(
-                    step, expected_lr, lr_val[0]))
+        lr_vals = run_lr_steps(exe, main_prog, decayed_lr, 20)
+
+        steps = np.arange(20, dtype='float64')
+        expected_lr = np.where(
+            steps < warmup_steps,
+            linear_lr_warmup(steps, warmup_steps, start_lr, end_lr), lr)
+
+        np.testing.assert_allclose(
+            lr_vals,
+            expected_lr,
+            rtol=0,
+            atol=5e-8,
+            err_msg='Test failed, expected {0}, but got {1}'.format(
+                expected_lr, lr_vals))
 
     def test_scalar_lr(self):
         def run_places(lr, start_lr, end_lr):
-            places = [fluid.CPUPlace()]
-            if core.is_compiled_with_cuda():
-                places.append(fluid.CUDAPlace(0))
-            for p in places:
+            for p in self._places:
                 self.run_scalar_lr(p, lr, start_lr, end_lr)
 
         # float
@@ -393,34 +434,43 @@ class TestLinearWamrupLearningRateDecayWithScalarInput(unittest.TestCase):
         run_places(lr, start_lr, end_lr)
 
 
-def reduce_lr_on_plateau(decay_rate, threshold, cooldown, patience, m, n, loss,
-                         var_list):
-    def is_better(current, best, m, n):
-        if m == 'min' and n == 'rel':
-            return current < best - best * threshold
-        elif m == 'min' and n == 'abs':
-            return current < best - threshold
-        elif m == 'max' and n == 'rel':
-            return current > best + best * threshold
-        else:  # mode == 'max' and epsilon_mode == 'abs':
-            return current > best + threshold
-
-    if var_list[2] > 0:
-        var_list[2] -= 1
-        return var_list[1]
-
-    if is_better(loss, var_list[0], m, n):
-        var_list[0] = loss
-        var_list[3] = 0
+# (mode, threshold_mode) -> is_better(current, best, threshold)
+_IS_BETTER = {
+    ('min', 'rel'): lambda cur, best, t: cur < best - best * t,
+    ('min', 'abs'): lambda cur, best, t: cur < best - t,
+    ('max', 'rel'): lambda cur, best, t: cur > best + best * t,
+    ('max', 'abs'): lambda cur, best, t: cur > best + t,
+}
+
+
+class ReduceState(object):
+    __slots__ = ['best', 'lr', 'cooldown', 'bad']
+
+    def __init__(self, best, lr, cooldown, bad):
+        self.best = best
+        self.lr = lr
+        self.cooldown = cooldown
+        self.bad = bad
+
+
+def reduce_lr_on_plateau(decay_rate, threshold, cooldown, patience, is_better,
+                         loss, state):
+    if state.cooldown > 0:
+        state.cooldown -= 1
+        return state.lr
+
+    if is_better(loss, state.best, threshold):
+        state.best = loss
+        state.bad = 0
     else:
-        var_list[3] += 1
-        if var_list[3] > patience:
-            var_list[2] = cooldown
-            var_list[3] = 0
-            new_lr = var_list[1] * decay_rate
-            var_list[1] = new_lr if var_list[1] - new_lr > 1e-8 else var_list[1]
+        state.bad += 1
+        if state.bad > patience:
+            state.cooldown = cooldown
+            state.bad = 0
+            new_lr = state.lr * decay_rate
+            state.lr = new_lr if state.lr - new_lr > 1e-8 else state.lr
 
-    return var_list[1]
+    return state.lr
 
 
 class TestReduceLROnPlateauDecay(unittest.TestCase):
@@ -464,39 +514,38 @@ class TestReduceLROnPlateauDecay(unittest.TestCase):
                 sgd = fluid.optimizer.SGD(learning_rate=lr,
                                           parameter_list=linear.parameters())
 
+                is_better = _IS_BETTER[(m, n)]
                 best = float("-10000") if m == "max" else float("10000")
-                expected_lr = 1.0
-                cooldown_counter = 0
-                num_bad_epochs = 0
-                var_list = [best, expected_lr, cooldown_counter, num_bad_epochs]
+                state = ReduceState(best, 1.0, 0, 0)
                 step_num = 0
-                epoch_num = 0
+                expected_lrs = np.empty(30)
+                actual_lrs = np.empty(30)
+                step_buf = np.empty(1, dtype='float32')
                 for epoch in range(30):
-                    total_loss = 0
-
                     for batch_id in range(2):
                         step_num += 1
-                        x = fluid.dygraph.to_variable(
-                            np.array([step_num]).astype('float32'))
+                        step_buf[0] = step_num
+                        # copy so that x does not alias the reused buffer
+                        x = fluid.dygraph.to_variable(step_buf, zero_copy=False)
                         loss = layers.sin(x)
                         sgd.minimize(loss)
-                        total_loss += loss
 
-                    epoch_num += 1
-                    # get expected lr from fluid
-                    avg_loss = total_loss / 1
-                    lr.step(avg_loss)
-                    actual_lr = lr().numpy()[0]
+                    # get expected lr from fluid, only the loss of the last
+                    # batch is monitored so no graph is kept across batches
+                    last_loss = loss.detach()
+                    lr.step(last_loss)
+                    actual_lrs[epoch] = float(lr())
 
                     # get expected lr form python
-                    expected_lr = reduce_lr_on_plateau(decay_rate, threshold,
-                                                       cooldown, patience, m, n,
-                                                       avg_loss, var_list)
-                    self.assertEqual(
-                        expected_lr,
-                        actual_lr,
-                        msg='Failed reduce lr scheduler in epoch {0}, Python result is {1}, Fluid result is {2}'.
-                        format(epoch_num, expected_lr, actual_lr))
+                    expected_lrs[epoch] = reduce_lr_on_plateau(
+                        decay_rate, threshold, cooldown, patience, is_better,
+                        last_loss, state)
+
+                np.testing.assert_array_equal(
+                    actual_lrs,
+                    expected_lrs,
+                    err_msg='Failed reduce lr scheduler, Python result is {0}, Fluid result is {1}'.
+                    format(expected_lrs, actual_lrs))
 
 
 if __name__ == '__main__':